@@ -37,14 +37,6 @@ import png  # PNG I/O: PyPNG from: https://gitlab.com/drj11/pypng
     └────-────────────────────────┘ """
 
 
-def create_image(X: int, Y: int, Z: int) -> list[list[list[int]]]:
-    """Create empty 3D nested list of X*Y*Z sizes"""
-
-    new_image = [[[0 for z in range(Z)] for x in range(X)] for y in range(Y)]
-
-    return new_image
-
-
 def png2list(in_filename: str) -> tuple[int, int, int, int, list[list[list[int]]], dict]:
     """Take PNG filename and return PNG data in a human-friendly form."""
 
@@ -57,10 +49,9 @@ def png2list(in_filename: str) -> tuple[int, int, int, int, list[list[list[int]]
     if info['bitdepth'] == 16:
         maxcolors = 65535  # Maximal value for 16-bit channel
 
-    imagedata = tuple(pixels)  # Creates tuple of bytes or whatever "pixels" generator returns
-
-    # Next part forcedly creates 3D list of int out of "imagedata" tuple of hell knows what
-    image3D = [[[int((imagedata[y])[(x * Z) + z]) for z in range(Z)] for x in range(X)] for y in range(Y)]
+    # Next part creates 3D list of int out of "pixels" rows (bytearray or array of int),
+    # every pixel is one slice of row unpacked into list, no per-channel indexing
+    image3D = [[[*row[x : x + Z]] for x in range(0, X * Z, Z)] for row in pixels]
     # List (image) of lists (rows) of lists (pixels) of ints (channels) created
 
     return (X, Y, Z, maxcolors, image3D, info)
@@ -78,13 +69,10 @@ def list2png(out_filename: str, image3D: list[list[list[int]]], info: dict) -> N
     info['size'] = (X, Y)
     info['planes'] = Z
 
-    # flattening 3D list to 1D list for PNG .write_array method
-    image1D = [c for row in image3D for px in row for c in px]
-
-    # Writing PNG
+    # Writing PNG, every row flattened to 1D list only when PyPNG asks for it, whole image is never flattened at once
     resultPNG = open(out_filename, mode='wb')
     writer = png.Writer(X, Y, **info)
-    writer.write_array(resultPNG, image1D)
+    writer.write(resultPNG, ([c for px in row for c in px] for row in image3D))
     resultPNG.close()  # Close output
 
     return None
@@ -98,22 +86,15 @@ def list2bin(in_list_3d: list[list[list[int]]], maxcolors: int) -> bytes:
     X = len(in_list_3d[0])
     Z = len(in_list_3d[0][0])
 
-    # Flattening 3D list to 1D list
-    in_list_1d = [c for row in in_list_3d for px in row for c in px]
-
-    if Z == 1:  # L image
+    if Z < 3:  # L and LA image, flattening to 1D list of L channel only, A channel skipped
         magic = 'P5'
+        in_list_1d = [px[0] for row in in_list_3d for px in row]
 
-    if Z == 2:  # LA image
-        magic = 'P5'
-        del in_list_1d[1::2]  # Deleting A channel
-
-    if Z == 3:  # RGB image
-        magic = 'P6'
-
-    if Z == 4:  # RGBA image
+    else:  # RGB and RGBA image, flattening 3D list to 1D list
         magic = 'P6'
-        del in_list_1d[3::4]  # Deleting A channel
+        in_list_1d = [c for row in in_list_3d for px in row for c in px]
+        if Z == 4:
+            del in_list_1d[3::4]  # Deleting A channel
 
     if maxcolors < 256:
         datatype = 'B'
@@ -133,67 +114,78 @@ def list2bin(in_list_3d: list[list[list[int]]], maxcolors: int) -> bytes:
 def filter(sourceimage: list[list[list[int]]], threshold_x: int, threshold_y: int) -> list[list[list[int]]]:
     """Average image pixels in a row until borderline threshold met, then repeat in a column.
 
-    Be careful: it works with RGB, so RGBA need to be fixed when saving!"""
+    Be careful: it works with RGB, so RGBA need to be fixed when saving!
+    Pixels of one averaged run may be the same list object, so result is to be read, not edited in place."""
 
     # Determining list sizes
     Y = len(sourceimage)
     X = len(sourceimage[0])
     Z = len(sourceimage[0][0])
 
-    # Creating empty intermediate image
-    medimage = create_image(X, Y, 3)
+    # Final image is built row by row below
+    resultimage = []
+
+    # Channel number checked once, row reader below always returns RGB pixels
+    if Z > 2:  # supposedly RGB and RGBA
+
+        def rgb_row(row: list[list[int]]) -> list[list[int]]:
+            return [pixel[0:3] for pixel in row]
 
-    # Creating empty final image
-    resultimage = create_image(X, Y, 3)
+    else:  # supposedly L and LA
 
+        def rgb_row(row: list[list[int]]) -> list[list[int]]:
+            return [[pixel[0]] * 3 for pixel in row]
+
+    first_pixel = rgb_row(sourceimage[0][0:1])[0]
+
+    # Both passes go together row by row: once row is averaged horizontally, it is fed into
+    # vertical pass at once, so intermediate image is never stored as a whole.
+    # Vertical pass keeps its running sums, count and start of run for every column.
     for y in range(0, Y, 1):
-        if Z > 2:
-            r_sum, g_sum, b_sum = r, g, b = sourceimage[0][0][0:3]
-        else:
-            channel = sourceimage[0][0][0]
-            r_sum, g_sum, b_sum = r, g, b = channel, channel, channel
+        # Source row copied as is, then averaged runs are overwritten in place
+        medrow = rgb_row(sourceimage[y])
+        r_sum, g_sum, b_sum = first_pixel
         x_start = 0
         number = 1
-        for x in range(0, X, 1):
-            if Z > 2:
-                r, g, b = sourceimage[y][x][0:3]
-            else:
-                channel = sourceimage[y][x][0]
-                r, g, b = channel, channel, channel
-
+        for x, (r, g, b) in enumerate(medrow):
             number += 1
             r_sum += r
             g_sum += g
             b_sum += b
-            if (abs(r - (r_sum / number)) > threshold_x) or (abs(g - (g_sum / number)) > threshold_x) or (abs(b - (b_sum / number)) > threshold_x) or x == X:
-                for i in range(x_start, x - 1, 1):
-                    medimage[y][i] = [int(r_sum / number), int(g_sum / number), int(b_sum / number)]
-                medimage[y][x] = [r, g, b]
+            # |channel - sum/number| > threshold, multiplied by number to stay in exact int, without float division
+            threshold_n = threshold_x * number
+            if (abs(r * number - r_sum) > threshold_n) or (abs(g * number - g_sum) > threshold_n) or (abs(b * number - b_sum) > threshold_n):
+                # Whole run filled with one slice assignment; pixels are only read afterwards, so may share one list
+                if x - 1 > x_start:
+                    medrow[x_start : x - 1] = [[int(r_sum / number), int(g_sum / number), int(b_sum / number)]] * (x - 1 - x_start)
                 x_start = x
                 number = 1
                 r_sum, g_sum, b_sum = r, g, b
-            else:
-                medimage[y][x] = [r, g, b]
 
-    for x in range(0, X, 1):
-        r_sum, g_sum, b_sum = r, g, b = medimage[0][0]
-        y_start = 0
-        number = 1
-        for y in range(0, Y, 1):
-            r, g, b = medimage[y][x]
-            number += 1
-            r_sum += r
-            g_sum += g
-            b_sum += b
-            if (abs(r - (r_sum / number)) > threshold_y) or (abs(g - (g_sum / number)) > threshold_y) or (abs(b - (b_sum / number)) > threshold_y) or x == X:
-                for i in range(y_start, y - 1, 1):
-                    resultimage[i][x] = [int(r_sum / number), int(g_sum / number), int(b_sum / number)]
-                resultimage[y][x] = [r, g, b]
-                y_start = y
-                number = 1
-                r_sum, g_sum, b_sum = r, g, b
+        if y == 0:  # every column starts from the first intermediate pixel
+            r_sums, g_sums, b_sums = ([channel] * X for channel in medrow[0])
+            numbers = [1] * X
+            y_starts = [0] * X
+
+        # Intermediate row becomes result row as is, then averaged column runs in rows above are overwritten
+        resultimage.append(medrow)
+        for x, (r, g, b) in enumerate(medrow):
+            number = numbers[x] + 1
+            r_sum = r_sums[x] + r
+            g_sum = g_sums[x] + g
+            b_sum = b_sums[x] + b
+            # |channel - sum/number| > threshold, multiplied by number to stay in exact int, without float division
+            threshold_n = threshold_y * number
+            if (abs(r * number - r_sum) > threshold_n) or (abs(g * number - g_sum) > threshold_n) or (abs(b * number - b_sum) > threshold_n):
+                average_pixel = [int(r_sum / number), int(g_sum / number), int(b_sum / number)]
+                for i in range(y_starts[x], y - 1, 1):
+                    resultimage[i][x] = average_pixel
+                y_starts[x] = y
+                numbers[x] = 1
+                r_sums[x], g_sums[x], b_sums[x] = r, g, b
             else:
-                resultimage[y][x] = [r, g, b]
+                numbers[x] = number
+                r_sums[x], g_sums[x], b_sums[x] = r_sum, g_sum, b_sum
 
     return resultimage
 
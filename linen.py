@@ -31,6 +31,7 @@ __maintainer__ = 'Ilya Razmanov'
 __email__ = 'ilyarazmanov@gmail.com'
 __status__ = 'Production'
 
+from array import array
 from time import ctime, time
 from tkinter import BOTH, Tk, filedialog
 from tkinter.ttk import Progressbar
@@ -65,10 +66,14 @@ if (sourcefilename == '') or (sourcefilename is None):
 # open PNG file {#aa0000}
 source = png.Reader(filename=sourcefilename)  # starting PyPNG
 
-# Opening image, iDAT comes to 'pixels' generator, to be tuple'd later {#aa0000, 13}
+# Opening image, iDAT comes to 'pixels' generator, to be flattened later {#aa0000, 16}
 X, Y, pixels, info = source.asRGBA()
 Z = info['planes']  # Maximum channel number
-imagedata = tuple(pixels)  # Building tuple from generator
+
+# Building one flat typed array from generator rows, channel values go row after row
+imagedata = array('H' if info['bitdepth'] > 8 else 'B')
+for row in pixels:
+    imagedata.extend(row)
 
 if info['bitdepth'] == 8:
     maxcolors = 255  # Maximal value for 8-bit channel
@@ -94,58 +99,31 @@ if (resultfilename == '') or (resultfilename is None):
     quit()
 
 # open POV file {#aa0000}
-resultfile = open(resultfilename, 'w')
+# Binary mode skips text layer encoding per write, header text is encoded by write_lines below
+resultfile = open(resultfilename, 'wb', buffering=1048576)  # 1 Mb buffer, few large writes
 
 # Both files opened
 
 
-def src(x, y, z):
+def write_lines(lines):
     '''
-    Analog of src from FM, force repeat edge instead of out of range.
-    Returns int channel value z for pixel x, y
+    Writes list of str lines to binary resultfile in one call, UTF-8 encoded.
 
     '''
-    # Repeat edge extrapolation {#cc0000}
-    cx = int(x)
-    cy = int(y)
-    cx = max(0, cx)
-    cx = min((X - 1), cx)
-    cy = max(0, cy)
-    cy = min((Y - 1), cy)
-
-    # Here is the main magic of turning two x, z into one array position {#cc0000}
-    position = (cx * Z) + z
-    channelvalue = int((imagedata[cy])[position])
-
-    return channelvalue
-
-
-# end of src function
+    resultfile.write(''.join(lines).encode('utf-8'))
 
 
-def src_lum(x, y):
-    '''
-    Returns brightness of pixel x, y
-
-    '''
-
-    if info['planes'] < 3:  # supposedly L and LA
-        yntensity = src(x, y, 0)
-    else:  # supposedly RGB and RGBA
-        yntensity = int(0.2989 * src(x, y, 0) + 0.587 * src(x, y, 1) + 0.114 * src(x, y, 2))
-
-    return yntensity
-
-
-# end of src_lum function
+# end of write_lines function
 
 # WRITING POV FILE
 
 seconds = time()
 localtime = ctime(seconds)  # will be used for randomization and for debug info
 
+scale_xyz = 1.0 / max(X, Y)  # Overall thething rescaling to 1:1 box factor, also used by camera in header
+
 #   POV header start # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '/*\n',
         'Persistence of Vision Ray Tracer Scene Description File\n',
@@ -165,7 +143,7 @@ resultfile.writelines(
 )
 
 #   Globals # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '\n',
         '#version 3.7;\n\n',
@@ -187,7 +165,7 @@ resultfile.writelines(
 #   POV header end
 
 # Thingie element, then scene # {#aaff88}
-resultfile.writelines(
+write_lines(
     [
         '\n/*  -----------------\n    |  Surface lab  |\n    -----------------  */\n',
         '\n//       Surface finish variants\n',
@@ -252,8 +230,8 @@ resultfile.writelines(
         '  right x*image_width/image_height\n',
         '  up y\n',
         '  sky <0, -1, 0>\n',
-        f'  direction <0, 0, vlength(camera_position - <0.0, 0.0, {1.0/max(X, Y)}>)>  // May alone work for many pictures. Otherwise fiddle with angle below\n',
-        f'  angle 2.0*(degrees(atan2({0.5 * max(X, Y)/X}, vlength(camera_position - <0.0, 0.0, {1.0/max(X, Y)}>)))) // Supposed to fit object, unless thingies are too high\n',
+        f'  direction <0, 0, vlength(camera_position - <0.0, 0.0, {scale_xyz:.6g}>)>  // May alone work for many pictures. Otherwise fiddle with angle below\n',
+        f'  angle 2.0*(degrees(atan2({0.5 * max(X, Y) / X:.6g}, vlength(camera_position - <0.0, 0.0, {scale_xyz:.6g}>)))) // Supposed to fit object, unless thingies are too high\n',
         '  look_at <0.0, 0.0, 0.0>\n',
         '}\n\n',
         # Light {#aaaa00, 2}
@@ -269,87 +247,91 @@ resultfile.writelines(
 
 # Now going to cycle through image and build big thething
 
-scale_xyz = 1.0 / max(X, Y)  # Overall thething rescaling to 1:1 box factor
+inv_maxcolors = 1.0 / maxcolors  # Channel values normalized to 0..1 by multiplication
+
+# Color channel text for every possible channel value, normalized to 0..1, made once instead of per pixel
+channel_strings = [b'%.6g' % (channel * inv_maxcolors) for channel in range(maxcolors + 1)]
+
+# Distortion pattern coordinate text for every column, made once for all rows
+column_sx = [b'%.6g' % (scale_xyz * x) for x in range(0, X, 1)]
+
+# Normal modifier is the same for every thingie, so defined once for all
+normal_string = 'normal{thingie_normal rotate(normal_rotate_rnd * (<rand(rnd_1), rand(rnd_1), rand(rnd_1)> - 0.5)) translate(normal_move_rnd * <rand(rnd_1), rand(rnd_1), rand(rnd_1)>)}'
+
+# Per-pixel text, filled with one substitution. Horizontal thingie goes first, vertical second,
+# which one is upper and which is lower is set by clipping planes according to checker pattern
+thingie_template = (
+    # horizontal {#0000ff, 7}
+    '    object {thingie\n'
+    '      pigment{rgb<cm(%(r)s), cm(%(g)s), cm(%(b)s)>}\n'
+    f'      finish{{thingie_finish}} {normal_string}\n'
+    '      scale(<1, 1, 1> + (scale_rnd * <0, 0, distort_s(scl_pat_x*%(sx)s, scl_pat_y*%(sy)s, rand(rnd_1))-0.5>))\n'
+    '      rotate(rotate_rnd * <distort_r1(rot_pat_x*%(sx)s, rot_pat_y*%(sy)s, rand(rnd_1))-0.5, 0, 0>)\n'
+    '      translate<%(x)d, %(y)d, 0>\n'
+    '      clipped_by{plane{%(clip_horz)s,0}}\n'
+    '    }\n'
+    # vertical {#ff0000, 7}
+    '    object {thingie\n'
+    '      pigment{rgb<cm(%(r)s), cm(%(g)s), cm(%(b)s)>}\n'
+    f'      finish{{thingie_finish}} {normal_string}\n'
+    '      scale(<1, 1, 1> + (scale_rnd * <0, 0, distort_s(scl_pat_x*%(sx)s, scl_pat_y*%(sy)s, rand(rnd_1))-0.5>))\n'
+    '      rotate(<0, 0, 90> + (rotate_rnd * <distort_r2(rot_pat_x*%(sx)s, rot_pat_y*%(sy)s, rand(rnd_1))-0.5, 0, 0>))\n'
+    '      translate<%(x)d, %(y)d, 0>\n'
+    '      clipped_by{plane{%(clip_vert)s,0}}\n'
+    '    }\n'
+).encode('utf-8')  # encoded once, filled with bytes keys and written as bytes
 
 progressbar.config(maximum=Y)
+progress_step = max(1, Y // 100)  # Progress bar redrawn about 100 times per image, not every row
 
 for y in range(0, Y, 1):
-    sortir.deiconify()  # {#8888ff, 3}
-    progressbar.config(value=y)
-    sortir.update()
-    sortir.update_idletasks()
-
-    resultfile.write(f'\n  // Row {y}\n')
-    for x in range(0, X, 1):
-        # Colors normalized to 0..1
-        r = float(src(x, y, 0)) / maxcolors
-        g = float(src(x, y, 1)) / maxcolors
-        b = float(src(x, y, 2)) / maxcolors
-
-        # Something to map something to. By default - brightness, normalized to 0..1
-        c = float(src_lum(x, y)) / maxcolors
-
-        # Grouping repetitive strings together for easy editing
-        normal_string = 'normal{thingie_normal rotate(normal_rotate_rnd * (<rand(rnd_1), rand(rnd_1), rand(rnd_1)> - 0.5)) translate(normal_move_rnd * <rand(rnd_1), rand(rnd_1), rand(rnd_1)>)}'
-        scale_string = f'scale(<1, 1, 1> + (scale_rnd * <0, 0, distort_s(scl_pat_x*{scale_xyz*x}, scl_pat_y*{scale_xyz*y}, rand(rnd_1))-0.5>))'
-        rotate_string_horz = f'rotate(rotate_rnd * <distort_r1(rot_pat_x*{scale_xyz*x}, rot_pat_y*{scale_xyz*y}, rand(rnd_1))-0.5, 0, 0>)'
-        rotate_string_vert = f'rotate(<0, 0, 90> + (rotate_rnd * <distort_r2(rot_pat_x*{scale_xyz*x}, rot_pat_y*{scale_xyz*y}, rand(rnd_1))-0.5, 0, 0>))'
-        # checker pattern {#aaff88}
-        if ((y + 1) % 2) == ((x + 1) % 2):
-            resultfile.writelines(
-                [
-                    # lower horizontal start from corner 0,0 #  {#0000ff, 8}
-                    '    object {thingie\n',
-                    f'      pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'      finish{{thingie_finish}} {normal_string}\n'
-                    f'      {scale_string}\n',
-                    f'      {rotate_string_horz}\n',
-                    f'      translate<{x}, {y}, 0>\n',
-                    '      clipped_by{plane{z,0}}\n',
-                    '    }\n',
-                    # upper vertical start from corner 0,0  {#ff0000, 8}
-                    '    object {thingie\n',
-                    f'      pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'      finish{{thingie_finish}} {normal_string}\n'
-                    f'      {scale_string}\n',
-                    f'      {rotate_string_vert}\n',
-                    f'      translate<{x}, {y}, 0>\n',
-                    '      clipped_by{plane{-z,0}}\n',
-                    '    }\n',
-                ]
-            )
+    if y % progress_step == 0:
+        sortir.deiconify()  # {#8888ff, 3}
+        progressbar.config(value=y)
+        sortir.update()  # update() processes idle tasks as well, no separate update_idletasks() needed
+
+    sy = b'%.6g' % (scale_xyz * y)  # Distortion pattern coordinate text, same for the whole row
 
+    # x and y never leave the image in loop below, so row is read directly, without src edge clamping.
+    # Row is split into channels by extended slices, so pixels come out of zip without any indexing
+    row = imagedata[y * X * Z : (y + 1) * X * Z]
+    row_parity = (y + 1) % 2  # checker pattern row phase
+
+    # Row text collected in list and written at once, one write call per row instead of per pixel
+    row_chunks = [b'\n  // Row %d\n' % y]
+    for x, (r, g, b) in enumerate(zip(row[0::Z], row[1::Z], row[2::Z])):
+        # checker pattern {#aaff88}
+        if row_parity == ((x + 1) % 2):
+            # lower horizontal, upper vertical, start from corner 0,0
+            clip_horz, clip_vert = b'z', b'-z'
         # checker pattern switch {#aaff88}
         else:
-            resultfile.writelines(
-                [
-                    # upper horizontal start from row 0 col 1  {#ff0000, 8}
-                    '    object {thingie\n',
-                    f'      pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'      finish{{thingie_finish}} {normal_string}\n'
-                    f'      {scale_string}\n',
-                    f'      {rotate_string_horz}\n',
-                    f'      translate<{x}, {y}, 0>\n',
-                    '      clipped_by{plane{-z,0}}\n',
-                    '    }\n',
-                    # lower vertical start from row 0 col 1  {#0000ff, 8}
-                    '    object {thingie\n',
-                    f'      pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'      finish{{thingie_finish}} {normal_string}\n'
-                    f'      {scale_string}\n',
-                    f'      {rotate_string_vert}\n',
-                    f'      translate<{x}, {y}, 0>\n',
-                    '      clipped_by{plane{z,0}}\n',
-                    '    }\n',
-                ]
-            )
+            # upper horizontal, lower vertical, start from row 0 col 1
+            clip_horz, clip_vert = b'-z', b'z'
+
+        row_chunks.append(
+            thingie_template
+            % {
+                b'r': channel_strings[r],
+                b'g': channel_strings[g],
+                b'b': channel_strings[b],
+                b'sx': column_sx[x],
+                b'sy': sy,
+                b'x': x,
+                b'y': y,
+                b'clip_horz': clip_horz,
+                b'clip_vert': clip_vert,
+            }
+        )
+
+    resultfile.write(b''.join(row_chunks))
 
 # Transform object to fit 1, 1, 1 cube at 0, 0, 0 coordinates  # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '\n  // Object transforms to fit 1, 1, 1 cube at 0, 0, 0 coordinates\n',
         f'  translate <0.5, 0.5, 0> + <{-0.5*X}, {-0.5*Y}, 0>\n',  # centering at scene zero
-        f'  scale<{1.0/max(X, Y)}, {1.0/max(X, Y)}, {1.0/max(X, Y)}>\n',  # fitting
+        f'  scale<{scale_xyz:.6g}, {scale_xyz:.6g}, {scale_xyz:.6g}>\n',  # fitting
         '} // thething closed\n\n'
         '\nobject {thething\n'  # inserting thething
         '  transform {thething_transform}\n',
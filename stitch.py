@@ -31,6 +31,8 @@ __maintainer__ = 'Ilya Razmanov'
 __email__ = 'ilyarazmanov@gmail.com'
 __status__ = 'Production'
 
+import gzip
+from array import array
 from random import random
 from time import ctime, time
 from tkinter import BOTH, Tk, filedialog
@@ -66,10 +68,14 @@ if (sourcefilename == '') or (sourcefilename is None):
 # open PNG file {#aa0000}
 source = png.Reader(filename=sourcefilename)  # starting PyPNG
 
-# Opening image, iDAT comes to 'pixels' generator, to be tuple'd later {#aa0000, 26}
-X, Y, pixels, info = source.asRGBA()
+# Opening image, iDAT comes to 'pixels' generator, to be flattened later {#aa0000, 28}
+X, Y, pixels, info = source.asDirect()  # L, LA, RGB or RGBA as is, palette expanded
 Z = info['planes']  # Maximum channel number
-imagedata = tuple(pixels)  # Building tuple from generator
+
+# Building one flat typed array from generator rows, channel values go row after row
+imagedata = array('H' if info['bitdepth'] > 8 else 'B')
+for row in pixels:
+    imagedata.extend(row)
 
 if info['bitdepth'] == 8:
     maxcolors = 255  # Maximal value for 8-bit channel
@@ -86,6 +92,7 @@ resultfilename = filedialog.asksaveasfilename(
     title='Save POVRay scene file',
     filetypes=[
         ('POV-Ray scene file', '*.pov'),
+        ('Compressed POV-Ray scene file', '*.pov.gz'),
         ('All Files', '*.*'),
     ],
     defaultextension=('POV-Ray scene file', '.pov'),
@@ -94,60 +101,35 @@ if (resultfilename == '') or (resultfilename is None):
     sortir.destroy()
     quit()
 
-# open POV file {#aa0000}
-resultfile = open(resultfilename, 'w')
+# open POV file, gzip compressed for storage if user chose .gz {#aa0000}
+# Binary mode skips text layer encoding per write, header text is encoded by write_lines below
+if resultfilename.endswith('.gz'):
+    resultfile = gzip.open(resultfilename, 'wb', compresslevel=1)
+else:
+    resultfile = open(resultfilename, 'wb', buffering=1048576)  # 1 Mb buffer, few large writes
 
 # Both files opened
 
 
-def src(x, y, z):
-    '''
-    Analog of src from FM, force repeat edge instead of out of range.
-    Returns int channel value z for pixel x, y
-
-    '''
-    # Repeat edge extrapolation {#cc0000}
-    cx = int(x)
-    cy = int(y)
-    cx = max(0, cx)
-    cx = min((X - 1), cx)
-    cy = max(0, cy)
-    cy = min((Y - 1), cy)
-
-    # Here is the main magic of turning two x, z into one array position {#cc0000}
-    position = (cx * Z) + z
-    channelvalue = int((imagedata[cy])[position])
-
-    return channelvalue
-
-
-# end of src function
-
-
-def src_lum(x, y):
+def write_lines(lines):
     '''
-    Returns brightness of pixel x, y
+    Writes list of str lines to binary resultfile in one call, UTF-8 encoded.
 
     '''
+    resultfile.write(''.join(lines).encode('utf-8'))
 
-    if info['planes'] < 3:  # supposedly L and LA
-        yntensity = src(x, y, 0)
-    else:  # supposedly RGB and RGBA
-        yntensity = int(0.2989 * src(x, y, 0) + 0.587 * src(x, y, 1) + 0.114 * src(x, y, 2))
 
-    return yntensity
-
-
-# end of src_lum function
+# end of write_lines function
 
 # WRITING POV FILE
 
 seconds = time()
 localtime = ctime(seconds)  # will be used for randomization and for debug info
 
+scale_xyz = 1.0 / max(X, Y)  # Overall thething rescaling to 1:1 box factor, also used by camera in header
 
 #   POV header start # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '/*\n',
         'Persistence of Vision Ray Tracer Scene Description File\n',
@@ -167,7 +149,7 @@ resultfile.writelines(
 )
 
 #   Globals # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '\n',
         '#version 3.7;\n\n',
@@ -189,7 +171,7 @@ resultfile.writelines(
 #   POV header end
 
 # Thingie element, then scene # {#aaff88}
-resultfile.writelines(
+write_lines(
     [
         '\n/*  -----------------\n    |  Surface lab  |\n    -----------------  */\n',
         '\n//       Surface finish variants\n',
@@ -240,6 +222,34 @@ resultfile.writelines(
         '#declare distort_r1 = function(x, y, z) {f_noise_generator(x, y, 0, 3)};    // Rotation pattern (upper), currently slice of 3D Perlin noise at z = 0.\n',
         '#declare distort_r2 = function(x, y, z) {f_noise_generator(x, y, 0.5, 3)};  // Rotation pattern (lower), currently slice of 3D Perlin noise at z = 0.5 to remove visual match between upper and lower.\n\n',
         '// #declare distort_s = function(x, y, z) {z}; // Regular random example\n',
+        '// distort_s is evaluated once per stitch, z gets rand(rnd_1) in 0..1. Value goes to scale as is, and to move minus 0.5,\n',
+        '// so with regular random example above scale distortion is 0..1, not centered on zero.\n',
+        '\n/*  -----------------------------------------------\n    |  Cross stitch macro, called once per pixel  |\n    -----------------------------------------------  */\n\n',
+        f'#declare pattern_scale = 1/{max(X, Y)};  // Pixel position to distortion pattern coordinates, fits image into 1, 1 square\n\n',
+        '#macro thingie_stitch(pigment_r, pigment_g, pigment_b, pos_x, pos_y)\n',
+        '  #local pat_x = pattern_scale*pos_x;\n',
+        '  #local pat_y = pattern_scale*pos_y;\n',
+        '  #local distortion = distort_s(scl_pat_x*pat_x, scl_pat_y*pat_y, rand(rnd_1));  // Evaluated once for both scale and move\n',
+        '  union{\n',
+        '    object {thingie  // upper +45 deg\n',  # {#ff0000, 6}
+        '      pigment{rgb<cm(pigment_r), cm(pigment_g), cm(pigment_b)>}\n',
+        '      finish{thingie_finish} normal{thingie_normal rotate(normal_rotate_rnd * (<rand(rnd_1), rand(rnd_1), rand(rnd_1)> - 0.5)) translate(normal_move_rnd * <rand(rnd_1), rand(rnd_1), rand(rnd_1)>)}\n',
+        '      scale(<1, 1, 1+t_off>)\n',
+        '      rotate(<0, 0, 45.0> + (rotate_rnd * <distort_r1(rot_pat_x*pat_x, rot_pat_y*pat_y, rand(rnd_1))-0.5, 0, 0>))\n',
+        '      clipped_by{plane{-z,0}}\n',
+        '    }\n',
+        '    object {thingie  // lower -45 deg\n',  # {#0000ff, 6}
+        '      pigment{rgb<cm(pigment_r), cm(pigment_g), cm(pigment_b)>}\n',
+        '      finish{thingie_finish} normal{thingie_normal rotate(normal_rotate_rnd * (<rand(rnd_1), rand(rnd_1), rand(rnd_1)> - 0.5)) translate(normal_move_rnd * <rand(rnd_1), rand(rnd_1), rand(rnd_1)>)}\n',
+        '      scale(<1, 1, 1-t_off>)\n',
+        '      rotate(<0, 0, -45.0> + (rotate_rnd * <distort_r2(rot_pat_x*pat_x, rot_pat_y*pat_y, rand(rnd_1))-0.5, 0, 0>))\n',
+        '      clipped_by{plane{-z,0}}\n',
+        '    }\n',
+        '    scale (<1, 1, 1> + (scale_rnd * distortion))\n',
+        '    translate move_rnd * (distortion - 0.5)\n',
+        '    translate <pos_x, pos_y, 0>\n',
+        '  }\n',
+        '#end\n',
         '\n/*  --------------------------------------------------\n    |  Some properties for whole thething and scene  |\n    --------------------------------------------------  */\n\n',
         '//       Common transform for the whole thething, placed here just to avoid scrolling\n',
         '#declare thething_transform = transform {\n  // You can place your global scale, rotate etc. here\n}\n',
@@ -256,8 +266,8 @@ resultfile.writelines(
         '  right x*image_width/image_height\n',
         '  up y\n',
         '  sky <0, -1, 0>\n',
-        f'  direction <0, 0, vlength(camera_position - <0.0, 0.0, {1.0/max(X, Y)}>)>  // May alone work for many pictures. Otherwise fiddle with angle below\n',
-        f'  angle 2.0*(degrees(atan2({0.5 * max(X, Y)/X}, vlength(camera_position - <0.0, 0.0, {1.0/max(X, Y)}>)))) // Supposed to fit object, unless thingies are too high\n',
+        f'  direction <0, 0, vlength(camera_position - <0.0, 0.0, {scale_xyz:.6g}>)>  // May alone work for many pictures. Otherwise fiddle with angle below\n',
+        f'  angle 2.0*(degrees(atan2({0.5 * max(X, Y) / X:.6g}, vlength(camera_position - <0.0, 0.0, {scale_xyz:.6g}>)))) // Supposed to fit object, unless thingies are too high\n',
         '  look_at <0.0, 0.0, 0.0>\n',
         '}\n\n',
         # Light {#aaaa00, 2}
@@ -273,71 +283,59 @@ resultfile.writelines(
 
 # Now going to cycle through image and build big thething
 
-scale_xyz = 1.0 / max(X, Y)  # Overall thething rescaling to 1:1 box factor
+inv_maxcolors = 1.0 / maxcolors  # Channel values normalized to 0..1 by multiplication
+
+# Color channel text for every possible channel value, normalized to 0..1, made once instead of per pixel.
+# Memory depends on bit depth only, not on number of colors in the image
+channel_strings = [b'%.6g' % (channel * inv_maxcolors) for channel in range(maxcolors + 1)]
+
+has_alpha = info['alpha']  # Without alpha every pixel is drawn, no dithering needed
+
+# Source split into flat per-channel planes once, so loop below reads plain values by x within row {#aa0000, 7}
+planes = [imagedata[z::Z] for z in range(Z)]
+if has_alpha:
+    plane_a = planes[Z - 1]  # Alpha plane exists and is read only for LA and RGBA
+if Z > 2:  # supposedly RGB and RGBA
+    plane_r, plane_g, plane_b = planes[0:3]
+else:  # supposedly L and LA, brightness goes to all colors
+    plane_r = plane_g = plane_b = planes[0]
+
+row_x = range(0, X, 1)  # Without alpha every pixel is drawn, same for all rows
 
 progressbar.config(maximum=Y)
+progress_step = max(1, Y // 100)  # Progress bar redrawn about 100 times per image, not every row
 
 for y in range(0, Y, 1):
-    sortir.deiconify()  # {#8888ff, 3}
-    progressbar.config(value=y)
-    sortir.update()
-    sortir.update_idletasks()
-
-    resultfile.write(f'\n  // Row {y}\n')
-    for x in range(0, X, 1):
-        # Colors normalized to 0..1
-        r = float(src(x, y, 0)) / maxcolors
-        g = float(src(x, y, 1)) / maxcolors
-        b = float(src(x, y, 2)) / maxcolors
-
-        # Something to map something to. By default - brightness, normalized to 0..1
-        c = float(src_lum(x, y)) / maxcolors
-
-        # alpha to be used for alpha dithering
-        a = float(src(x, y, 3)) / maxcolors
-        # a = 0 is transparent, a = 1.0 is opaque
-        tobe_or_nottobe = a > random()
-
-        # whether to draw thingie in place of partially transparent pixel or not
-        if tobe_or_nottobe:
-            # Grouping repetitive strings together for easy editing
-            normal_string = 'normal{thingie_normal rotate(normal_rotate_rnd * (<rand(rnd_1), rand(rnd_1), rand(rnd_1)> - 0.5)) translate(normal_move_rnd * <rand(rnd_1), rand(rnd_1), rand(rnd_1)>)}'
-            rotate_string_1 = f'(rotate_rnd * <distort_r1(rot_pat_x*{scale_xyz*x}, rot_pat_y*{scale_xyz*y}, rand(rnd_1))-0.5, 0, 0>)'
-            rotate_string_2 = f'(rotate_rnd * <distort_r2(rot_pat_x*{scale_xyz*x}, rot_pat_y*{scale_xyz*y}, rand(rnd_1))-0.5, 0, 0>)'
-            resultfile.writelines(
-                [
-                    # Union #  {#ff0000}
-                    '    union{\n',
-                    # upper +45 deg #  {#ff0000, 7}
-                    '      object {thingie\n',
-                    f'        pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'        finish{{thingie_finish}} {normal_string}\n'
-                    f'        scale(<1, 1, 1+t_off>)\n',
-                    f'        rotate(<0, 0, 45.0> + {rotate_string_1})\n',
-                    '        clipped_by{plane{-z,0}}\n',
-                    '      }\n',
-                    # lower -45 deg #  {#0000ff, 7}
-                    '      object {thingie\n',
-                    f'        pigment{{rgb<cm({r}), cm({g}), cm({b})>}}\n',
-                    f'        finish{{thingie_finish}} {normal_string}\n'
-                    f'        scale(<1, 1, 1-t_off>)\n',
-                    f'        rotate(<0, 0, -45.0> + {rotate_string_2})\n',
-                    '        clipped_by{plane{-z,0}}\n',
-                    '      }\n',
-                    f'     scale (<1, 1, 1> + (scale_rnd * distort_s(scl_pat_x*{scale_xyz*x}, scl_pat_y*{scale_xyz*y}, rand(rnd_1) - 0.5) ) )\n',
-                    f'     translate move_rnd * (distort_s(scl_pat_x*{scale_xyz*x}, scl_pat_y*{scale_xyz*y}, rand(rnd_1)) - 0.5)\n',
-                    f'     translate <{x}, {y}, 0>\n',
-                    '    }\n',
-                ]
-            )
+    if y % progress_step == 0:
+        sortir.deiconify()  # {#8888ff, 3}
+        progressbar.config(value=y)
+        sortir.update()  # update() processes idle tasks as well, no separate update_idletasks() needed
+
+    row_start, row_end = y * X, (y + 1) * X
+    row_r, row_g, row_b = plane_r[row_start:row_end], plane_g[row_start:row_end], plane_b[row_start:row_end]
+
+    # alpha dithering decides whether to draw thingie in place of partially transparent pixel or not,
+    # a = 0 is transparent, a = 1.0 is opaque. random() is called neither for opaque nor for fully transparent pixels.
+    # Loop below only walks pixels to be drawn, without checking anything
+    if has_alpha:
+        row_a = plane_a[row_start:row_end]
+        row_x = [x for x, alpha in enumerate(row_a) if (alpha == maxcolors) or (alpha and (alpha * inv_maxcolors > random()))]
+
+    # Row text collected in list and written at once, one write call per row instead of per pixel
+    row_chunks = [b'\n  // Row %d\n' % y]
+    for x in row_x:
+        # Colors come ready made from channel_strings lookup table
+        row_chunks.append(b'    thingie_stitch(%s, %s, %s, %d, %d)\n' % (channel_strings[row_r[x]], channel_strings[row_g[x]], channel_strings[row_b[x]], x, y))
+
+    resultfile.write(b''.join(row_chunks))
 
 
 # Transform object to fit 1, 1, 1 cube at 0, 0, 0 coordinates  # {#aaaa00}
-resultfile.writelines(
+write_lines(
     [
         '\n  // Object transforms to fit 1, 1, 1 cube at 0, 0, 0 coordinates\n',
         f'  translate <0.5, 0.5, 0> + <{-0.5*X}, {-0.5*Y}, 0>\n',  # centering at scene zero
-        f'  scale<{scale_xyz}, {scale_xyz}, {scale_xyz}>\n',  # fitting
+        f'  scale<{scale_xyz:.6g}, {scale_xyz:.6g}, {scale_xyz:.6g}>\n',  # fitting
         '} // thething closed\n\n'
         '\nobject {thething\n'  # inserting thething
         '  transform {thething_transform}\n',